@@ -1,19 +1,87 @@
+import logging
+import os
 import numpy as np
 
-# A simple in-memory dictionary to act as our database.
-# Keys will be the user_id (str), and values will be the face encoding (numpy array).
-fake_user_db = {}
+logger = logging.getLogger(__name__)
+
+# A simple mock database for face templates.
+# Every template lives in one contiguous (N, 128) float32 matrix, and the index
+# maps each user_id (str) to its row. Both are persisted as binary .npy files
+# next to this module; on startup the matrix is memory-mapped instead of parsed,
+# and every registration is written back as soon as it is saved.
+DB_DIR         = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_FILE = os.path.join(DB_DIR, "user_templates.npy")
+USER_IDS_FILE  = os.path.join(DB_DIR, "user_ids.npy")
+ENCODING_DIM   = 128
+
+_templates = np.empty((0, ENCODING_DIM), dtype=np.float32)
+_user_rows = {}
+_dirty     = False
+
+
+def load_user_database():
+    """
+    Loads persisted templates, if any. The matrix is opened with mmap_mode='r',
+    so startup cost is independent of how many users are registered.
+    """
+    global _templates, _user_rows
+    if not (os.path.exists(TEMPLATES_FILE) and os.path.exists(USER_IDS_FILE)):
+        return
+
+    user_ids = np.load(USER_IDS_FILE, allow_pickle=False)
+    _user_rows = {str(user_id): row for row, user_id in enumerate(user_ids)}
+    _templates = np.load(TEMPLATES_FILE, mmap_mode="r")
+
+
+def save_user_database():
+    """
+    Writes the matrix and user ids if anything changed since the last load
+    or save. Both go to per-process temporary files that are swapped in, so
+    a matrix that is still memory-mapped is never truncated underneath us.
+    """
+    global _dirty
+    if not _dirty:
+        return
+
+    user_ids = np.array(sorted(_user_rows, key=_user_rows.get), dtype=str)
+    for path, array in ((TEMPLATES_FILE, _templates), (USER_IDS_FILE, user_ids)):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(tmp_path, path)
+    _dirty = False
+
 
 def save_user_template(user_id: str, encoding: np.ndarray):
     """
-    Saves a user's face encoding to the mock database.
+    Saves a user's face encoding to the mock database and writes it to disk.
+    Stored as float32: half the footprint of float64, and distance checks
+    are insensitive to the extra rounding.
     """
-    fake_user_db[user_id] = encoding
-    print(f"[DB LOG] Saved template for user: {user_id}")
+    global _templates, _dirty
+    row = np.asarray(encoding, dtype=np.float32).reshape(1, ENCODING_DIM)
+
+    if user_id in _user_rows:
+        if not _templates.flags.writeable:
+            # First write after a load: promote the read-only mmap into RAM
+            _templates = np.array(_templates)
+        _templates[_user_rows[user_id]] = row
+    else:
+        _user_rows[user_id] = len(_templates)
+        _templates = np.vstack([_templates, row])
+
+    _dirty = True
+    # Persist now rather than at shutdown, so a crash or kill loses nothing
+    save_user_database()
+    logger.debug("Saved template for user: %s", user_id)
+
 
 def get_user_template(user_id: str):
     """
     Retrieves a user's face encoding from the mock database.
     Returns None if the user is not found.
     """
-    return fake_user_db.get(user_id)
+    row = _user_rows.get(user_id)
+    if row is None:
+        return None
+    return _templates[row]
@@ -1,22 +1,102 @@
 import numpy as np
 import json
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from typing import List
 import uvicorn
 
-import io
-
 import face_recognition
 
 from pydantic import BaseModel
 
 
-from services.face_service import FaceRecognitionService
-from database.mock_db import save_user_template, get_user_template
-
-app = FastAPI(title="Secure Biometric Attendance System - V3")
+from services.face_service import FaceRecognitionService, report_dlib_build, warm_up_models
+from database.mock_db import load_user_database, save_user_database, save_user_template
+
+
+logger = logging.getLogger(__name__)
+
+MP_CONTEXT = multiprocessing.get_context()
+
+# Resolved once here; an unknown name would make setLevel raise in the parent
+# and in every pool initializer, so it falls back to INFO (warned at startup).
+LOG_LEVEL_NAME = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVEL = logging.getLevelName(LOG_LEVEL_NAME)
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+
+
+def start_logging(log_queue):
+    """
+    Handlers on the event loop only enqueue records; a background listener
+    thread formats them and writes to stdout. Pool workers enqueue onto the
+    same multiprocessing queue (see init_pool_worker). Level comes from
+    LOG_LEVEL (set WARNING in production to drop info records entirely).
+    """
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream)
+
+    queue_handler = QueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    if logging.getLevelName(LOG_LEVEL_NAME) != LOG_LEVEL:
+        logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL_NAME)
+    return listener, queue_handler
+
+
+def init_pool_worker(log_queue, log_level, warmed):
+    # Runs once in each pool process: ship its log records to the parent's
+    # listener, then warm the models and report in.
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(log_level)
+    warm_up_models(warmed)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # dlib/OpenCV work is CPU-bound and would otherwise block the event loop,
+    # so every request's ML step runs in this pool (models load per worker).
+    # Each worker warms its models when it starts; /ready reports when all are up.
+    # The pool is created, and its workers forked, before the log listener
+    # thread exists, so no worker is forked from a multi-threaded parent.
+    app.state.ready = False
+    app.state.log_queue = MP_CONTEXT.Queue()
+    pool_start = start_ml_pool()
+
+    log_listener, log_handler = start_logging(app.state.log_queue)
+    report_dlib_build()
+    load_user_database()
+    app.state.warm_up = asyncio.create_task(start_pool_workers(*pool_start))
+    yield
+    app.state.warm_up.cancel()
+    app.state.ml_pool.shutdown()
+    save_user_database()
+    logging.getLogger().removeHandler(log_handler)
+    log_listener.stop()
+
+
+app = FastAPI(
+    title="Secure Biometric Attendance System - V3",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,19 +118,123 @@ class ErrorResponse(BaseModel):
     error: str
 
 
-def load_image_from_upload(upload_file: UploadFile) -> np.ndarray:
-    contents = upload_file.file.read()
-    image = face_recognition.load_image_file(io.BytesIO(contents))
-    return image
+# The mock DB is per-process memory written back to shared .npy files, so a
+# second web worker would overwrite the first one's registrations. uvicorn reads
+# WEB_CONCURRENCY itself when --workers is not given, so refuse it on import,
+# which every launch path (python main.py, uvicorn main:app) goes through.
+try:
+    _web_concurrency = int(os.environ.get("WEB_CONCURRENCY", "1"))
+except ValueError:
+    _web_concurrency = 1
+if _web_concurrency > 1:
+    raise RuntimeError(
+        f"WEB_CONCURRENCY={_web_concurrency} is not supported with the mock "
+        "database: every web worker keeps its own users in memory and they "
+        "overwrite each other's files. Run a single worker."
+    )
+
+
+def ml_pool_size() -> int:
+    # Face work scales across cores through this one process pool
+    return os.cpu_count() or 1
+
+
+def start_ml_pool():
+    workers = ml_pool_size()
+    warmed = MP_CONTEXT.Value("i", 0)
+    app.state.ml_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=MP_CONTEXT,
+        initializer=init_pool_worker,
+        initargs=(app.state.log_queue, LOG_LEVEL, warmed),
+    )
+    # One trivial job per worker forces every process (and its initializer)
+    # to start now rather than on the first request.
+    spawned = [app.state.ml_pool.submit(os.getpid) for _ in range(workers)]
+    return workers, warmed, spawned
+
+
+def restart_ml_pool():
+    logger.error("An ML worker died and broke the process pool; starting a new one")
+    app.state.ready = False
+    app.state.ml_pool.shutdown(wait=False, cancel_futures=True)
+    app.state.warm_up.cancel()
+    app.state.warm_up = asyncio.create_task(start_pool_workers(*start_ml_pool()))
+
+
+async def run_in_pool(fn, *args):
+    loop = asyncio.get_running_loop()
+    pool = app.state.ml_pool
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # One dead worker (OOM kill, dlib crash) fails every job on the pool.
+        # Jobs that failed together share a single replacement, then each is
+        # retried once; a job that breaks the new pool too is not retried.
+        if app.state.ml_pool is pool:
+            restart_ml_pool()
+        return await loop.run_in_executor(app.state.ml_pool, fn, *args)
+
+
+async def start_pool_workers(workers: int, warmed, spawned):
+    # The spawn jobs can all land on whichever worker warms first, so
+    # readiness waits on the shared counter each initializer bumps instead.
+    await asyncio.gather(*map(asyncio.wrap_future, spawned))
+    while warmed.value < workers:
+        await asyncio.sleep(0.1)
+    app.state.ready = True
+
+
+# Re-uploads of the same registration image (retries, dev loops) skip dlib.
+# Keyed by (purpose, content digest); oldest entries are evicted first.
+ENCODING_CACHE_SIZE = 1024
+_encoding_cache = OrderedDict()
+
+
+def image_key(purpose: str, image_bytes: bytes):
+    return purpose, hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+
+def cache_get(key):
+    value = _encoding_cache.get(key)
+    if value is not None:
+        _encoding_cache.move_to_end(key)
+    return value
+
+
+def cache_put(key, value):
+    _encoding_cache[key] = value
+    if len(_encoding_cache) > ENCODING_CACHE_SIZE:
+        _encoding_cache.popitem(last=False)
+
+
+# Health checks poll this constantly; serve pre-rendered bytes from the event
+# loop instead of re-serializing in FastAPI's threadpool on every call.
+_HOME_BODY = ORJSONResponse({"message": "Biometric System V3 (Blink Liveness) is Running"}).body
+
 
 @app.get("/")
-def home():
-    return {"message": "Biometric System V3 (Blink Liveness) is Running"}
+async def home():
+    return Response(content=_HOME_BODY, media_type="application/json")
+
+
+@app.get("/ready")
+async def ready():
+    # A dead worker marks the executor broken right away, before any request
+    # trips over it and replaces the pool (which clears ready until re-warmed).
+    if not app.state.ready or app.state.ml_pool._broken:
+        return ORJSONResponse({"ready": False}, status_code=503)
+    return ORJSONResponse({"ready": True})
 
 
 def get_face_encoding(image_bytes: bytes) -> dict:
-    image = face_recognition.load_image_file(io.BytesIO(image_bytes))
-    face_encodings = face_recognition.face_encodings(image)
+    # Decode straight from the upload bytes (no BytesIO/PIL round trip)
+    image = face_service.decode_rgb(image_bytes)
+    if image is None:
+        return {"success": False, "encoding": None, "message": "Could not decode image"}
+
+    face_locations = face_service.detect_faces(image)
+    face_encodings = face_recognition.face_encodings(image, face_locations)
 
     if len(face_encodings) == 0:
         return {"success": False, "encoding": None, "message": "No face detected in image"}
@@ -81,16 +265,20 @@ async def generate_encoding(
 
         # Read bytes and pass to helper
         image_bytes = await image.read()
-        result = get_face_encoding(image_bytes)
+        key = image_key("generate-encoding", image_bytes)
+        result = cache_get(key)
+        if result is None:
+            result = await run_in_pool(get_face_encoding, image_bytes)
+            if result["success"]:
+                cache_put(key, result)
 
         if not result["success"]:
             raise HTTPException(status_code=400, detail=result["message"])
 
-        return EncodingResponse(
-            success=True,
-            encoding=result["encoding"],
-            message=result["message"]
-        )
+        # result already has EncodingResponse's shape; returning a response
+        # directly skips validating the 128 floats twice (model + response_model).
+        # The model is still declared above for the OpenAPI docs.
+        return ORJSONResponse(result)
 
     except HTTPException:
         raise
@@ -99,9 +287,13 @@ async def generate_encoding(
 @app.post("/api/users/register")
 async def register_user(user_id: str = Form(...), file: UploadFile = File(...)):
     image_bytes = await file.read()
-    encoding, is_live, msg = face_service.analyze_challenge(image_bytes)
+    key = image_key("register", image_bytes)
+    encoding = cache_get(key)
     if encoding is None:
-        raise HTTPException(status_code=400, detail=msg)
+        encoding, is_live, msg = await run_in_pool(face_service.analyze_challenge, image_bytes)
+        if encoding is None:
+            raise HTTPException(status_code=400, detail=msg)
+        cache_put(key, encoding)
     save_user_template(user_id, encoding)
     return {"status": "success", "message": f"User {user_id} registered successfully."}
 
@@ -111,18 +303,41 @@ async def mark_attendance(
      stored_embedding_json: str = Form(...),
      files: List[UploadFile] = File(...)
  ):
-     stored_encoding = np.array(json.loads(stored_embedding_json))
+     stored_encodings = np.atleast_2d(
+         np.asarray(json.loads(stored_embedding_json), dtype=np.float32)
+     )
      frames_bytes = [await f.read() for f in files]
-     captured_encoding, is_live, msg = face_service.analyze_blink_sequence(frames_bytes)
+     # Frames are independent, so decode + landmarks + EAR fan out across the
+     # pool. The blink decision is cheap and runs here; only the last frame
+     # with a face goes back to the pool to be encoded.
+     frame_results = await asyncio.gather(
+         *(run_in_pool(face_service.frame_ear, frame_bytes) for frame_bytes in frames_bytes)
+     )
+     # Plain dicts of str/bool are rendered by orjson directly, skipping
+     # FastAPI's jsonable_encoder pass on every attendance attempt.
+     last_face, msg = face_service.check_blink(frame_results)
+     if last_face is None:
+         return ORJSONResponse({"verified": False, "message": msg, "confidence": "0%"})
+     captured_encoding, is_live, msg = await run_in_pool(
+         face_service.encode_face, frames_bytes[last_face], frame_results[last_face][1]
+     )
      if not is_live:
-         return {"verified": False, "message": msg, "confidence": "0%"}
-     is_match, confidence = face_service.verify_user(captured_encoding, stored_encoding)
+         return ORJSONResponse({"verified": False, "message": msg, "confidence": "0%"})
+     is_match, confidence = face_service.verify_user(captured_encoding, stored_encodings)
      if is_match:
-         return {"verified": True, "confidence": f"{confidence}%"}
-     return {"verified": False, "message": "Biometric Mismatch", "confidence": f"{confidence}%"}
+         return ORJSONResponse({"verified": True, "confidence": f"{confidence}%"})
+     return ORJSONResponse({"verified": False, "message": "Biometric Mismatch", "confidence": f"{confidence}%"})
 
 
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # "auto" picks uvloop and httptools when installed (not on Windows)
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=1,
+    )
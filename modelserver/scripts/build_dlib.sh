@@ -0,0 +1,44 @@
+#!/usr/bin/env bash
+# Rebuilds dlib from source with SIMD enabled for the current machine.
+# Generic wheels can ship without AVX/NEON, which makes HOG detection and the
+# ResNet encoder an order of magnitude slower. The model server logs the
+# detected build flags at startup; run this script if it warns.
+#
+# Usage: ./scripts/build_dlib.sh   (inside the model server's virtualenv)
+set -euo pipefail
+
+DLIB_VERSION="${DLIB_VERSION:-20.0.0}"
+WORKDIR="$(mktemp -d)"
+trap 'rm -rf "$WORKDIR"' EXIT
+
+case "$(uname -m)" in
+    x86_64|amd64)
+        COMPILER_FLAGS="-O3 -march=native -mavx2"
+        SIMD_OPTION="USE_AVX_INSTRUCTIONS=1"
+        ;;
+    aarch64|arm64)
+        # NEON is always available on 64-bit ARM; -mfpu is a 32-bit-only flag
+        COMPILER_FLAGS="-O3 -mcpu=native"
+        SIMD_OPTION="USE_NEON_INSTRUCTIONS=1"
+        ;;
+    armv7l|armhf)
+        COMPILER_FLAGS="-O3 -mfpu=neon"
+        SIMD_OPTION="USE_NEON_INSTRUCTIONS=1"
+        ;;
+    *)
+        echo "Unsupported architecture: $(uname -m)" >&2
+        exit 1
+        ;;
+esac
+
+pip download --no-deps --no-binary :all: "dlib==${DLIB_VERSION}" -d "$WORKDIR"
+tar -xzf "$WORKDIR/dlib-${DLIB_VERSION}.tar.gz" -C "$WORKDIR"
+cd "$WORKDIR/dlib-${DLIB_VERSION}"
+
+pip uninstall -y dlib || true
+python setup.py install \
+    --set DLIB_NO_GUI_SUPPORT=YES \
+    --set "$SIMD_OPTION" \
+    --compiler-flags "$COMPILER_FLAGS"
+
+python -c "import dlib; print('AVX:', dlib.USE_AVX_INSTRUCTIONS, 'NEON:', dlib.USE_NEON_INSTRUCTIONS, 'CUDA:', dlib.DLIB_USE_CUDA)"
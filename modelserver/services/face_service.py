@@ -1,7 +1,59 @@
+import logging
+import math
+import dlib
 import face_recognition
 import numpy as np
 import cv2
-from scipy.spatial import distance as dist
+from face_recognition.api import (
+    face_detector,
+    face_encoder,
+    pose_predictor_5_point,
+    pose_predictor_68_point,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def report_dlib_build():
+    """
+    Logs the acceleration dlib was compiled with. Wheels built without
+    AVX/NEON (or CUDA) are an order of magnitude slower at detection and
+    encoding; see scripts/build_dlib.sh.
+    """
+    flags = {
+        name: bool(getattr(dlib, name, False))
+        for name in (
+            "DLIB_USE_CUDA",
+            "USE_AVX_INSTRUCTIONS",
+            "USE_NEON_INSTRUCTIONS",
+            "DLIB_USE_BLAS",
+        )
+    }
+    logger.info(
+        "dlib %s: %s", dlib.__version__, ", ".join(f"{k}={v}" for k, v in flags.items())
+    )
+    if not any(v for k, v in flags.items() if k != "DLIB_USE_BLAS"):
+        logger.warning(
+            "dlib was built without CUDA, AVX or NEON. "
+            "Face detection will be very slow; rebuild with scripts/build_dlib.sh."
+        )
+
+
+def warm_up_models(warmed=None):
+    """
+    Runs the detector, both landmark predictors and the ResNet encoder once on
+    a blank frame, so the first real request does not pay their one-time
+    allocation (and, on CUDA builds, context setup) cost.
+    warmed is an optional shared multiprocessing counter, bumped once done.
+    """
+    blank = np.zeros((256, 256, 3), dtype=np.uint8)
+    box   = dlib.rectangle(0, 0, 255, 255)
+    face_detector(blank, 0)
+    pose_predictor_68_point(blank, box)
+    face_encoder.compute_face_descriptor(blank, pose_predictor_5_point(blank, box))
+    if warmed is not None:
+        with warmed.get_lock():
+            warmed.value += 1
 
 
 class FaceRecognitionService:
@@ -9,103 +61,197 @@ class FaceRecognitionService:
         self.TOLERANCE            = 0.50
         self.EAR_CLOSED_THRESHOLD = 0.22
         self.EAR_OPEN_THRESHOLD   = 0.28
+        # HOG detection runs on a copy whose long side is at most this many px
+        self.DETECTION_MAX_SIDE   = 480
 
     def calculate_ear(self, eye_points):
-        A = dist.euclidean(eye_points[1], eye_points[5])
-        B = dist.euclidean(eye_points[2], eye_points[4])
-        C = dist.euclidean(eye_points[0], eye_points[3])
+        # Plain scalar math: scipy's euclidean validates and wraps its inputs
+        # on every call, which dwarfs the arithmetic for six 2-D points.
+        p0, p1, p2, p3, p4, p5 = eye_points.tolist()
+        A = math.hypot(p1[0] - p5[0], p1[1] - p5[1])
+        B = math.hypot(p2[0] - p4[0], p2[1] - p4[1])
+        C = math.hypot(p0[0] - p3[0], p0[1] - p3[1])
         if C == 0:
             return 0.0
         return (A + B) / (2.0 * C)
 
-    def analyze_challenge(self, image_bytes):
-        """Single-frame analysis used during registration."""
+    def decode_rgb(self, image_bytes):
+        """
+        Decodes JPEG/PNG bytes straight into an RGB array. Letting imdecode
+        emit RGB saves a separate full-frame BGR->RGB cvtColor pass.
+        Returns None if the bytes are not a valid image.
+        """
         nparr = np.frombuffer(image_bytes, np.uint8)
-        img   = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img is None:
-            return None, False, "Image capture failed."
+        return cv2.imdecode(nparr, cv2.IMREAD_COLOR_RGB)
 
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def downscale(self, rgb_img):
+        """
+        Returns (image, scale): a copy whose long side is at most
+        DETECTION_MAX_SIDE (or the frame itself if already small enough),
+        and the factor that was applied.
+        """
+        height, width = rgb_img.shape[:2]
+        scale = min(self.DETECTION_MAX_SIDE / max(height, width), 1.0)
+        if scale < 1:
+            rgb_img = cv2.resize(rgb_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return rgb_img, scale
 
-        face_locations = face_recognition.face_locations(rgb_img)
-        if not face_locations:
-            return None, False, "No face detected in frame."
+    def upscale_location(self, face_location, scale, shape):
+        """Maps a (top, right, bottom, left) box found at `scale` back onto a frame of `shape`."""
+        top, right, bottom, left = face_location
+        height, width = shape[:2]
+        return (
+            max(int(top / scale), 0),
+            min(int(right / scale), width),
+            min(int(bottom / scale), height),
+            max(int(left / scale), 0),
+        )
 
-        encodings = face_recognition.face_encodings(rgb_img, face_locations)
-        if not encodings:
-            return None, False, "Could not extract face encoding."
+    def detect_faces(self, rgb_img):
+        """
+        Runs the HOG detector on a downscaled copy of the frame and maps the
+        boxes back to full-resolution (top, right, bottom, left) tuples, so
+        landmarks and encodings are still computed on the original pixels.
+        """
+        small, scale = self.downscale(rgb_img)
 
-        return encodings[0], True, "Registration frame accepted."
+        # Selfie-distance faces are found without upsampling; only fall back
+        # to the 4x-cost upsampled pass when nothing is detected.
+        rects = face_detector(small, 0)
+        if len(rects) == 0:
+            rects = face_detector(small, 1)
 
-    def analyze_blink_sequence(self, frames_bytes):
+        locations = []
+        for rect in rects:
+            box = (rect.top(), rect.right(), rect.bottom(), rect.left())
+            locations.append(self.upscale_location(box, scale, rgb_img.shape))
+        return locations
+
+    def eye_points(self, rgb_img, face_location):
         """
-        Analyzes a sequence of JPEG frames to confirm a genuine blink.
-        Requires the pattern: OPEN → CLOSED → OPEN
-        Returns: (encoding, is_live, status_message)
+        Runs the 68-point predictor on one face and returns only the two eye
+        contours (landmarks 36-41 and 42-47) as (6, 2) float32 arrays, without
+        building the full per-feature landmark dict.
         """
-        ear_series    = []
-        last_encoding = None
+        top, right, bottom, left = face_location
+        parts = pose_predictor_68_point(rgb_img, dlib.rectangle(left, top, right, bottom)).parts()
+        left_eye  = np.array([(parts[i].x, parts[i].y) for i in range(36, 42)], dtype=np.float32)
+        right_eye = np.array([(parts[i].x, parts[i].y) for i in range(42, 48)], dtype=np.float32)
+        return left_eye, right_eye
 
-        for frame_bytes in frames_bytes:
-            nparr = np.frombuffer(frame_bytes, np.uint8)
-            img   = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            if img is None:
-                continue
+    def frame_ear(self, frame_bytes):
+        """
+        Decodes one blink frame and measures its average EAR.
+        Returns (avg_ear, face_location), or None if no face is visible.
+        """
+        rgb_img = self.decode_rgb(frame_bytes)
+        if rgb_img is None:
+            return None
 
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # EAR is a ratio, so the whole liveness step (detection and landmarks)
+        # runs on the downscaled frame; only the box is mapped back to full
+        # resolution for the final encoding.
+        small, scale = self.downscale(rgb_img)
+        face_locations = self.detect_faces(small)
+        if not face_locations:
+            return None
 
-            face_locations = face_recognition.face_locations(rgb_img)
-            if not face_locations:
-                continue
+        left_eye, right_eye = self.eye_points(small, face_locations[0])
+        left_ear  = self.calculate_ear(left_eye)
+        right_ear = self.calculate_ear(right_eye)
+        return (left_ear + right_ear) / 2.0, self.upscale_location(face_locations[0], scale, rgb_img.shape)
 
-            landmarks_list = face_recognition.face_landmarks(rgb_img, face_locations)
-            if not landmarks_list:
-                continue
+    def blink_detected(self, ear_series):
+        """
+        Vectorized OPEN → CLOSED → OPEN check over the whole EAR series:
+        the first open frame, then the first closed frame after it, then any
+        open frame after that.
+        """
+        ears   = np.asarray(ear_series)
+        opened = np.flatnonzero(ears >= self.EAR_OPEN_THRESHOLD)
+        if opened.size == 0:
+            return False
 
-            lm        = landmarks_list[0]
-            left_ear  = self.calculate_ear(lm['left_eye'])
-            right_ear = self.calculate_ear(lm['right_eye'])
-            avg_ear   = (left_ear + right_ear) / 2.0
-            ear_series.append(avg_ear)
+        closed = np.flatnonzero(ears[opened[0]:] <= self.EAR_CLOSED_THRESHOLD)
+        if closed.size == 0:
+            return False
 
-            encodings = face_recognition.face_encodings(rgb_img, face_locations)
-            if encodings:
-                last_encoding = encodings[0]
+        return bool(opened[-1] > opened[0] + closed[0])
 
+    def analyze_challenge(self, image_bytes):
+        """Single-frame analysis used during registration."""
+        rgb_img = self.decode_rgb(image_bytes)
+        if rgb_img is None:
+            return None, False, "Image capture failed."
+
+        face_locations = self.detect_faces(rgb_img)
+        if not face_locations:
+            return None, False, "No face detected in frame."
+
+        encodings = face_recognition.face_encodings(rgb_img, face_locations)
+        if not encodings:
+            return None, False, "Could not extract face encoding."
+
+        return encodings[0], True, "Registration frame accepted."
+
+    def check_blink(self, frame_results):
+        """
+        Runs the blink decision over per-frame frame_ear() outputs (None for
+        frames without a face). Cheap enough for the request process.
+        Returns: (index of the last frame with a face, or None; status_message)
+        """
+        ear_series = [result[0] for result in frame_results if result is not None]
         if len(ear_series) < 5:
-            return None, False, "Not enough valid frames. Keep your face visible."
-
-        # State machine: OPEN → CLOSED → OPEN
-        STATE_OPEN   = "open"
-        STATE_CLOSED = "closed"
-        state           = None
-        blink_confirmed = False
-
-        for ear in ear_series:
-            if state is None:
-                if ear >= self.EAR_OPEN_THRESHOLD:
-                    state = STATE_OPEN
-            elif state == STATE_OPEN:
-                if ear <= self.EAR_CLOSED_THRESHOLD:
-                    state = STATE_CLOSED
-            elif state == STATE_CLOSED:
-                if ear >= self.EAR_OPEN_THRESHOLD:
-                    blink_confirmed = True
-                    break
-
-        if not blink_confirmed:
-            return None, False, (
+            return None, "Not enough valid frames. Keep your face visible."
+
+        if not self.blink_detected(ear_series):
+            return None, (
                 "Liveness Failed: No blink detected. "
                 "Please close your eyes fully, then open them."
             )
 
-        if last_encoding is None:
+        last_face = max(i for i, result in enumerate(frame_results) if result is not None)
+        return last_face, "Blink Verified!"
+
+    def encode_face(self, frame_bytes, face_location):
+        """
+        Encodes the face at face_location (full-resolution box) in one frame.
+        Returns: (encoding, is_live, status_message)
+        """
+        rgb_img = self.decode_rgb(frame_bytes)
+        if rgb_img is None:
+            return None, False, "Face encoding could not be extracted."
+
+        encodings = face_recognition.face_encodings(rgb_img, [face_location])
+        if not encodings:
             return None, False, "Face encoding could not be extracted."
 
-        return last_encoding, True, "Blink Verified!"
+        return encodings[0], True, "Blink Verified!"
 
-    def verify_user(self, captured_encoding, stored_encoding):
-        distance   = face_recognition.face_distance([stored_encoding], captured_encoding)[0]
+    def analyze_blink_sequence(self, frames_bytes):
+        """
+        Analyzes a sequence of JPEG frames to confirm a genuine blink.
+        Requires the pattern: OPEN → CLOSED → OPEN
+        Only the last frame with a face is encoded, and only once the blink
+        is confirmed.
+        Returns: (encoding, is_live, status_message)
+        """
+        frame_results = [self.frame_ear(frame_bytes) for frame_bytes in frames_bytes]
+        last_face, msg = self.check_blink(frame_results)
+        if last_face is None:
+            return None, False, msg
+
+        return self.encode_face(frames_bytes[last_face], frame_results[last_face][1])
+
+    def verify_user(self, captured_encoding, stored_encodings):
+        """
+        Compares the captured encoding against every stored template in one
+        vectorized pass. stored_encodings is a (N, 128) float32 matrix; the
+        closest template decides the match.
+        """
+        known      = np.atleast_2d(stored_encodings)
+        diff       = known - np.asarray(captured_encoding, dtype=np.float32)
+        distance   = float(np.sqrt(np.einsum('ij,ij->i', diff, diff)).min())
         is_match   = distance <= self.TOLERANCE
         confidence = round((1 - distance) * 100, 2)
         return is_match, confidence